@@ -4,23 +4,286 @@ import sys
 sys.path.append("include")
 from builtins import int
 import sys
+import time
+import functools
+import logging
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
 import GageSupport as gs
 import GageConstants as gc
 import numpy as np
 import PyGage3_64 as PyGage
 
+log = logging.getLogger(__name__)
+
+# numba is optional, if it isn't installed the numpy version of the ADC to
+# volts conversion is used instead
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# cupy is optional too, it's only used to allocate page-locked memory for data
+# that will be sent to a GPU
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+
+if njit is not None:
+
+    @njit(parallel=True, nogil=True, fastmath=True, cache=True)
+    def _affine(x, a, b, out):
+        # b - a * x, prange splits the loop across cores and no temporaries
+        # are made. a and b are arguments (not compiled in) so the kernel is
+        # cached to disk and compiled only once
+        for i in prange(x.size):
+            out[i] = b - a * x[i]
+
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _affine_serial(x, a, b, out):
+        # single threaded _affine for use off the main thread
+        for i in range(x.size):
+            out[i] = b - a * x[i]
+
+
+def convert_adc_to_volts(x, a, b, out=None, parallel=True):
+    # ((SampleOffset - x) / SampleRes) * scale_factor + offset collapses to
+    # b - a * x, with a and b calculated once per capture (see get_data). This
+    # way only one array is allocated instead of three temporaries. float32 is
+    # plenty for 14 - 16 bit ADC data and is half the size of float64.
+    # parallel=False has to be used off the main thread, numba's default
+    # threading layer hangs the interpreter at exit otherwise
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+
+    # the kernels work on flat arrays, reshape(-1) of a non contiguous out
+    # would be a copy that the result gets written to instead
+    if njit is not None and out.flags.c_contiguous:
+        affine = _affine if parallel else _affine_serial
+        affine(x.reshape(-1), np.float32(a), np.float32(b), out.reshape(-1))
+    else:
+        np.multiply(x, np.float32(-a), out=out, dtype=np.float32)
+        out += np.float32(b)
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def _errstr(code):
+    # the same few error codes come up over and over, no need to go through
+    # the driver every time
+    return PyGage.GetErrorString(code)
+
+
+class PyGageError(Exception):
+    # raised with the CompuScope error code when a PyGage call fails
+    def __init__(self, code):
+        super().__init__(_errstr(code))
+        self.code = code
+
+
+def _setup_logging():
+    # warnings go to the console, but only add the handler once
+    if not log.handlers:
+        log.addHandler(logging.StreamHandler())
+
+
+def _check(r):
+    # PyGage returns a negative int instead of the result when a call fails,
+    # turning that into an exception keeps the happy path straight-line
+    if isinstance(r, int) and r < 0:
+        raise PyGageError(r)
+    return r
+
+
+# GetAcquisitionConfig and GetChannelConfig build fresh dicts every call, the
+# results are kept here per handle until configure_system or free_system is
+# called
+_cfg_cache = {}
+
+
+def clear_config_cache(handle):
+    for key in [key for key in _cfg_cache if key[0] == handle]:
+        del _cfg_cache[key]
+
 
-def convert_adc_to_volts(x, stHeader, scale_factor, offset):
-    return (
-        ((stHeader["SampleOffset"] - x) / stHeader["SampleRes"]) * scale_factor
-    ) + offset
+def get_acquisition_config(handle):
+    key = (handle, "acq")
+    if key not in _cfg_cache:
+        _cfg_cache[key] = _check(PyGage.GetAcquisitionConfig(handle))
+    return _cfg_cache[key]
 
 
-def normalize(vec):
-    return vec / np.max(abs(vec))
+def get_channel_config(handle, channel):
+    key = (handle, "chan", channel)
+    if key not in _cfg_cache:
+        _cfg_cache[key] = _check(PyGage.GetChannelConfig(handle, channel))
+    return _cfg_cache[key]
+
+
+def get_scale(handle):
+    # a and b used by convert_adc_to_volts, they only depend on the
+    # acquisition and channel config so they're cached alongside them
+    key = (handle, "scale")
+    if key not in _cfg_cache:
+        acq = get_acquisition_config(handle)
+        chan = get_channel_config(handle, 1)
+
+        scale_factor = chan["InputRange"] / 2000
+        offset = chan["DcOffset"] / 1000
+
+        a = scale_factor / acq["SampleResolution"]
+        b = offset + acq["SampleOffset"] * a
+        _cfg_cache[key] = (a, b)
+    return _cfg_cache[key]
+
+
+def free_system(handle):
+    clear_config_cache(handle)
+    PyGage.FreeSystem(handle)
+
+
+def get_pinned_array(shape, dtype):
+    # page-locked host memory lets host -> GPU copies go straight through the
+    # DMA engine instead of being staged. cupy pools the pinned allocations so
+    # the cost of pinning is only paid once across captures. Falls back to a
+    # regular numpy array if cupy isn't installed
+    if cp is None:
+        return np.empty(shape, dtype=dtype)
+    size = int(np.prod(shape))
+    mem = cp.cuda.alloc_pinned_memory(size * np.dtype(dtype).itemsize)
+    return np.frombuffer(mem, dtype, size).reshape(shape)
+
+
+if njit is not None:
+
+    @njit(fastmath=True, cache=True)
+    def _normalize(vec, out):
+        # a hand written max loop vectorizes, and there's no abs(vec) temporary
+        m = 0.0
+        for i in range(vec.size):
+            v = vec[i]
+            v = -v if v < 0 else v
+            if v > m:
+                m = v
+        # out is left alone for an all zero vec, normalize fills in the NaN
+        if m == 0:
+            return m
+        inv = 1.0 / m
+        for i in range(vec.size):
+            out[i] = vec[i] * inv
+        return m
+
+
+if njit is not None:
+
+    @njit(fastmath=True, cache=True)
+    def _normalize_int16(vec, out):
+        # max(|x|) in the integer domain, promoted to int32 so that |-32768|
+        # doesn't overflow
+        m = np.int32(0)
+        for i in range(vec.size):
+            v = np.int32(vec[i])
+            v = -v if v < 0 else v
+            if v > m:
+                m = v
+        # out is left alone for an all zero vec, see normalize
+        if m == 0:
+            return m
+        inv = np.float32(1.0) / np.float32(m)
+        for i in range(vec.size):
+            out[i] = vec[i] * inv
+        return m
+
+
+def normalize_int16(vec, out=None):
+    # normalize raw int16 ADC data straight to float32, skips the float64
+    # intermediate that normalize would make for integer input
+    if out is None:
+        out = np.empty(vec.shape, dtype=np.float32)
+
+    # the kernel works on flat arrays, see convert_adc_to_volts
+    if njit is not None and out.flags.c_contiguous:
+        m = _normalize_int16(vec.reshape(-1), out.reshape(-1))
+    else:
+        m = max(int(vec.max()), -int(vec.min()))
+        if m != 0:
+            np.multiply(vec, np.float32(1.0 / m), out=out, dtype=np.float32)
+
+    if m == 0:
+        log.warning("normalizing an all zero array, the result is NaN")
+        out[...] = np.nan
+    return out
+
+
+def normalize_from_adc(x, a, b, out=None):
+    """
+    Same as normalize(convert_adc_to_volts(x, a, b)) but straight from the raw
+    ADC values, without making the volts array in between.
+
+    Volts are b - a * x = -a * (x - c), with c = b / a the ADC value at 0 V. So
+    the normalized data is s * (x - c) with s = -sign(a) / max|x - c|, and
+    max|x - c| only needs x.max() and x.min() which are done in the integer
+    domain.
+
+    Args:
+        x (array): raw ADC data
+        a (float): scale, see get_scale
+        b (float): offset, see get_scale
+        out (array, optional): float32 output array
+
+    Returns:
+        float32 array
+    """
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+
+    c = b / a
+    m = max(float(x.max()) - c, c - float(x.min()))
+    if m == 0:
+        # every sample is at 0 V, see normalize
+        log.warning("normalizing an all zero array, the result is NaN")
+        out[...] = np.nan
+        return out
+    s = -np.sign(a) / m
+
+    # s * (x - c) written as b' - a' * x. The kernel works on flat arrays, see
+    # convert_adc_to_volts
+    if njit is not None and out.flags.c_contiguous:
+        _affine(x.reshape(-1), np.float32(-s), np.float32(-c * s), out.reshape(-1))
+    else:
+        np.multiply(x, np.float32(s), out=out, dtype=np.float32)
+        out -= np.float32(c * s)
+    return out
+
+
+def normalize(vec, out=None):
+    # out can be vec itself to normalize in place. An all zero vec comes out
+    # as NaN (0 / 0), same as vec / np.max(abs(vec))
+    if out is None:
+        if np.issubdtype(vec.dtype, np.floating):
+            out = np.empty(vec.shape, dtype=vec.dtype)
+        else:
+            out = np.empty(vec.shape, dtype=np.float64)
+
+    # the kernel works on flat arrays, see convert_adc_to_volts
+    if njit is not None and out.flags.c_contiguous:
+        m = _normalize(vec.reshape(-1), out.reshape(-1))
+    else:
+        # two reductions without allocating abs(vec), then one multiply
+        m = max(float(vec.max()), -float(vec.min()))
+        if m != 0:
+            np.multiply(vec, 1.0 / m, out=out)
+
+    if m == 0:
+        log.warning("normalizing an all zero array, the result is NaN")
+        out[...] = np.nan
+    return out
 
 
 def configure_system(handle, filename, segment_size=None):
+    clear_config_cache(handle)
     acq, sts = gs.LoadAcquisitionConfiguration(handle, filename)
 
     # added this
@@ -34,39 +297,42 @@ def configure_system(handle, filename, segment_size=None):
         if status < 0:
             return status
     else:
-        print("Using defaults for acquisition parameters")
+        log.warning("Using defaults for acquisition parameters")
 
     if sts == gs.INI_FILE_MISSING:
-        print("Missing ini file, using defaults")
+        log.warning("Missing ini file, using defaults")
     elif sts == gs.PARAMETERS_MISSING:
-        print(
+        log.warning(
             "One or more acquisition parameters missing, using defaults for missing values"
         )
 
     system_info = PyGage.GetSystemInfo(handle)
-    acq = PyGage.GetAcquisitionConfig(
-        handle
-    )  # check for error - copy to GageAcquire.py
+    acq = get_acquisition_config(handle)  # check for error - copy to GageAcquire.py
 
     channel_increment = gs.CalculateChannelIndexIncrement(
         acq["Mode"], system_info["ChannelCount"], system_info["BoardCount"]
     )
 
+    # local names for the functions / constants used in the loops below
+    load_channel = gs.LoadChannelConfiguration
+    set_channel = PyGage.SetChannelConfig
+    parameters_missing = gs.PARAMETERS_MISSING
+
     missing_parameters = False
     for i in range(1, system_info["ChannelCount"] + 1, channel_increment):
-        chan, sts = gs.LoadChannelConfiguration(handle, i, filename)
+        chan, sts = load_channel(handle, i, filename)
         if isinstance(chan, dict) and chan:
-            status = PyGage.SetChannelConfig(handle, i, chan)
+            status = set_channel(handle, i, chan)
             if status < 0:
                 return status
         else:
-            print("Using default parameters for channel ", i)
+            log.warning("Using default parameters for channel %d", i)
 
-        if sts == gs.PARAMETERS_MISSING:
+        if sts == parameters_missing:
             missing_parameters = True
 
     if missing_parameters:
-        print(
+        log.warning(
             "One or more channel parameters missing, using defaults for missing values"
         )
 
@@ -83,57 +349,79 @@ def configure_system(handle, filename, segment_size=None):
             if status < 0:
                 return status
         else:
-            print("Using default parameters for trigger ", i)
+            log.warning("Using default parameters for trigger %d", i)
 
-        if sts == gs.PARAMETERS_MISSING:
+        if sts == parameters_missing:
             missing_parameters = True
 
     if missing_parameters:
-        print(
+        log.warning(
             "One or more trigger parameters missing, using defaults for missing values"
         )
 
     status = PyGage.Commit(handle)
+    # the config can change on commit
+    clear_config_cache(handle)
     return status, channel_increment
 
 
+class HandleResult(NamedTuple):
+    # result of get_handle. If ok is False, handle holds the error code and
+    # err the error string
+    ok: bool
+    handle: int
+    err: str
+
+
 def get_handle():
     status = PyGage.Initialize()
     if status < 0:
-        return status
-    else:
-        handle = PyGage.GetSystem(0, 0, 0, 0)
-        return handle
+        return HandleResult(False, status, _errstr(status))
 
+    handle = PyGage.GetSystem(0, 0, 0, 0)
+    if handle < 0:
+        return HandleResult(False, handle, _errstr(handle))
+    return HandleResult(True, handle, "")
 
-def get_data(handle, mode, app, system_info, channel_increment):
-    status = PyGage.StartCapture(handle)
-    if status < 0:
-        return status
 
-    status = PyGage.GetStatus(handle)
-    while status != gc.ACQ_STATUS_READY:
-        status = PyGage.GetStatus(handle)
+def capture(handle):
+    _check(PyGage.StartCapture(handle))
+
+    # sleep in between polls instead of spinning a core at 100%, backing off
+    # from 1 us to 100 us so short captures are still picked up quickly
+    get_status = PyGage.GetStatus
+    sleep = time.sleep
+    ready = gc.ACQ_STATUS_READY
 
-    acq = PyGage.GetAcquisitionConfig(handle)
+    wait = 1e-6
+    status = _check(get_status(handle))
+    while status != ready:
+        sleep(wait)
+        wait = min(wait * 2, 1e-4)
+        status = _check(get_status(handle))
+    return status
+
+
+def get_header(handle, app):
+    acq = get_acquisition_config(handle)
 
     # Validate the start address and the length. This is especially
     # necessary if trigger delay is being used.
     min_start_address = acq["TriggerDelay"] + acq["Depth"] - acq["SegmentSize"]
     if app["StartPosition"] < min_start_address:
-        print(
-            "\nInvalid Start Address was changed from {0} to {1}".format(
-                app["StartPosition"], min_start_address
-            )
+        log.warning(
+            "Invalid Start Address was changed from %d to %d",
+            app["StartPosition"],
+            min_start_address,
         )
         app["StartPosition"] = min_start_address
 
     max_length = acq["TriggerDelay"] + acq["Depth"] - min_start_address
     if app["TransferLength"] > max_length:
-        print(
-            "\nInvalid Transfer Length was changed from {0} to {1}".format(
-                app["TransferLength"], max_length
-            )
+        log.warning(
+            "Invalid Transfer Length was changed from %d to %d",
+            app["TransferLength"],
+            max_length,
         )
         app["TransferLength"] = max_length
 
@@ -156,50 +444,183 @@ def get_data(handle, mode, app, system_info, channel_increment):
     else:
         stHeader["SegmentCount"] = acq["SegmentCount"]
 
-    buffer_list = []
-    for i in range(1, system_info["ChannelCount"] + 1, channel_increment):
-        buffer = PyGage.TransferData(
-            handle, i, 0, 1, app["StartPosition"], app["TransferLength"]
-        )
-        if isinstance(buffer, int):  # an error occurred
-            print("Error transferring channel ", 1)
-            return buffer
-        buffer_list.append(buffer)
-
-    # if call succeeded (buffer is not an integer) then
-    # buffer[0] holds the actual data, buffer[1] holds
-    # the actual start and buffer[2] holds the actual length
-
-    chan = PyGage.GetChannelConfig(handle, 1)
+    chan = get_channel_config(handle, 1)
     stHeader["InputRange"] = chan["InputRange"]
     stHeader["DcOffset"] = chan["DcOffset"]
 
-    scale_factor = stHeader["InputRange"] / 2000
-    offset = stHeader["DcOffset"] / 1000
+    a, b = get_scale(handle)
+    return stHeader, a, b
+
+
+def transfer_channels(
+    handle, app, system_info, channel_increment, out=None, scale=None, pinned=False
+):
+    # transfer all the channels into one contiguous (channel, sample) array,
+    # or (channel, segment, sample) for multiple record captures. If out isn't
+    # given it's allocated once the first transfer tells us the size. If
+    # scale = (a, b) is given, each transfer is converted to volts right after
+    # it's transferred while it's still in cache, otherwise the raw ADC values
+    # are copied over.
+    # PyGage only transfers one segment per call, so for multiple records
+    # the best we can do is loop over segments into the one preallocated array
+    channels = range(1, system_info["ChannelCount"] + 1, channel_increment)
+    segment_count = get_acquisition_config(handle)["SegmentCount"]
+    transfer = PyGage.TransferData
+    start = app["StartPosition"]
+    length = app["TransferLength"]
+    for n, i in enumerate(channels):
+        for segment in range(1, segment_count + 1):
+            buffer = _check(transfer(handle, i, 0, segment, start, length))
+
+            # if call succeeded (no PyGageError) then
+            # buffer[0] holds the actual data, buffer[1] holds
+            # the actual start and buffer[2] holds the actual length
+            if out is None:
+                if segment_count == 1:
+                    shape = (len(channels), buffer[0].size)
+                else:
+                    shape = (len(channels), segment_count, buffer[0].size)
+
+                if scale is None:
+                    out = np.empty(shape, dtype=buffer[0].dtype)
+                elif pinned:
+                    out = get_pinned_array(shape, np.float32)
+                else:
+                    out = np.empty(shape, dtype=np.float32)
+
+            dest = out[n] if segment_count == 1 else out[n, segment - 1]
+            if scale is None:
+                dest[:] = buffer[0]
+            else:
+                convert_adc_to_volts(buffer[0], *scale, out=dest)
+    return out
+
+
+def get_data(
+    handle, mode, app, system_info, channel_increment, pinned=False, raw=False
+):
+    status = capture(handle)
+
+    stHeader, a, b = get_header(handle, app)
+
+    # if raw is True the ADC values are returned without converting to volts,
+    # for when the data is only going to be normalized (see normalize_from_adc)
+    if raw:
+        data = transfer_channels(handle, app, system_info, channel_increment)
+        return status, data
 
     # buffer[0] is a numpy array I don't know why in their code they converted
     # the array to list and then used map, it's a heck of a lot longer to do
     # it that way.
-    data_list = []
-    for buffer in buffer_list:
-        data = convert_adc_to_volts(buffer[0], stHeader, scale_factor, offset)
-        data_list.append(data)
-
-    return status, data_list
-
+    data = transfer_channels(
+        handle, app, system_info, channel_increment, scale=(a, b), pinned=pinned
+    )
+    return status, data
+
+
+def acquire_once(handle, app, system_info, channel_increment, out):
+    """
+    One capture, start to finish, written into a caller provided float32
+    array so nothing is allocated per call. get_header (which validates app)
+    has to have been called once beforehand.
+
+    This is the whole StartCapture -> poll -> TransferData -> convert sequence
+    behind one call, so it can later be swapped for a compiled extension with
+    the same signature.
+
+    Args:
+        handle (int): card handle
+        app (dict): application config
+        system_info (dict): system info
+        channel_increment (int): channel increment
+        out (array): float32 array, same shape get_data returns
+
+    Returns:
+        int: status, a PyGageError is raised if an error occurred
+    """
+    status = capture(handle)
+    transfer_channels(
+        handle, app, system_info, channel_increment, out=out, scale=get_scale(handle)
+    )
+    return status
+
+
+def stream_segments(n, handle, app, system_info, channel_increment, pinned=False):
+    """
+    Repeated captures with ping-pong buffers, capture k + 1 is transferred
+    off the card while capture k is converted to volts on a separate thread
+    (numpy and numba release the GIL).
+
+    Args:
+        n (int): number of captures
+        handle (int): card handle
+        app (dict): application config
+        system_info (dict): system info
+        channel_increment (int): channel increment
+        pinned (bool, optional): convert into pinned memory
+
+    Yields:
+        2D array (channel, sample) of volts. The array is reused three
+        captures later (it stays valid until the second next() after it was
+        yielded), so copy it if you want to keep it around.
+    """
+    _, a, b = get_header(handle, app)
+
+    # three volts buffers: one with the caller, one held over from the
+    # capture before it, and one being converted into
+    raw = [None, None]
+    volts = [None, None, None]
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for k in range(n):
+            capture(handle)
+
+            j = k % 2
+            raw[j] = transfer_channels(
+                handle, app, system_info, channel_increment, out=raw[j]
+            )
 
-def acquire(segment_size, handle=None, inifile="../GaGe_Python/Acquire.ini"):
+            v = k % 3
+            if volts[v] is None:
+                if pinned:
+                    volts[v] = get_pinned_array(raw[j].shape, np.float32)
+                else:
+                    volts[v] = np.empty(raw[j].shape, dtype=np.float32)
+
+            # wait for the previous conversion, then start on this one while
+            # the caller works on the previous one and the next one transfers
+            previous = pending.result() if pending is not None else None
+            pending = executor.submit(
+                convert_adc_to_volts, raw[j], a, b, volts[v], parallel=False
+            )
+            if previous is not None:
+                yield previous
+
+        if pending is not None:
+            yield pending.result()
+
+
+def acquire(
+    segment_size,
+    handle=None,
+    inifile="../GaGe_Python/Acquire.ini",
+    pinned=False,
+    raw=False,
+):
+    # if raw is True, the raw ADC data is returned together with the (a, b)
+    # needed by convert_adc_to_volts / normalize_from_adc:
+    # data, (a, b) = acquire(segment_size, raw=True)
+    _setup_logging()
     try:
         # initialization common amongst all sample programs:
         # ---------------------------------------------------------------------
         # if handle is None, then get the handle for the first card available
         if handle is None:
-            handle = get_handle()
-            if handle < 0:
-                # get error string
-                error_string = PyGage.GetErrorString(handle)
-                print("Error: ", error_string)
+            result = get_handle()
+            if not result.ok:
+                print("Error: ", result.err)
                 raise SystemExit
+            handle = result.handle
 
         # in case handle was supplied, make sure handle is an int here if it
         # was supplied and doesn't refer to a card, the error will be caught
@@ -210,8 +631,8 @@ def acquire(segment_size, handle=None, inifile="../GaGe_Python/Acquire.ini"):
         if not isinstance(
             system_info, dict
         ):  # if it's not a dict, it's an int indicating an error
-            print("Error: ", PyGage.GetErrorString(system_info))
-            PyGage.FreeSystem(handle)
+            print("Error: ", _errstr(system_info))
+            free_system(handle)
             raise SystemExit
 
         print("\nBoard Name: ", system_info["BoardName"])
@@ -219,10 +640,10 @@ def acquire(segment_size, handle=None, inifile="../GaGe_Python/Acquire.ini"):
         status, channel_increment = configure_system(handle, inifile, segment_size)
         if status < 0:
             # get error string
-            error_string = PyGage.GetErrorString(status)
+            error_string = _errstr(status)
             print("Error: ", error_string)
         else:
-            acq_config = PyGage.GetAcquisitionConfig(handle)
+            acq_config = get_acquisition_config(handle)
             app, sts = gs.LoadApplicationConfiguration(inifile)
 
             if segment_size is not None:
@@ -231,7 +652,7 @@ def acquire(segment_size, handle=None, inifile="../GaGe_Python/Acquire.ini"):
             # we don't need to check for gs.INI_FILE_MISSING because if there's no ini file
             # we've already reported when calling configure_system
             if sts == gs.PARAMETERS_MISSING:
-                print(
+                log.warning(
                     "One or more application parameters missing, using defaults for missing values"
                 )
 
@@ -239,19 +660,24 @@ def acquire(segment_size, handle=None, inifile="../GaGe_Python/Acquire.ini"):
             # initialization done
 
             status, data_list = get_data(
-                handle, acq_config["Mode"], app, system_info, channel_increment
+                handle,
+                acq_config["Mode"],
+                app,
+                system_info,
+                channel_increment,
+                pinned=pinned,
+                raw=raw,
             )
-            if isinstance(status, int):
-                if status < 0:
-                    error_string = PyGage.GetErrorString(status)
-                    print("Error: ", error_string)
-
-                # these error checks regard the saving of the data
+            scale = get_scale(handle)
 
             # free the handle and return the data data
-            PyGage.FreeSystem(handle)
+            free_system(handle)
+            if raw:
+                return data_list, scale
             return data_list
+    except PyGageError as e:
+        print("Error: ", e)
     except KeyboardInterrupt:
         print("Exiting program")
 
-    PyGage.FreeSystem(handle)
+    free_system(handle)
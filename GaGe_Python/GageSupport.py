@@ -8,6 +8,7 @@ except ImportError:
 
 import sys
 import os.path  # to check that file exists
+import stat
     
 from GageConstants import (CS_MASKED_MODE, TIMESTAMP_MCLK, TIMESTAMP_FREERUN,
                            CS_COUPLING_DC, CS_COUPLING_AC, CS_TRIG_COND_NEG_SLOPE,
@@ -55,23 +56,45 @@ def CalculateChannelIndexIncrement(mode, channel_count, board_count):
     return channel_increment		
 	
 
-def LoadAcquisitionConfiguration(handle, iniFile):
-    # Get current values for fields that aren't in the ini file
-    acq = PyGage.GetAcquisitionConfig(handle)
-    if not isinstance(acq, dict):
-        return acq	
+# parsed ini files, keyed by path. Each entry holds the file's modification
+# time and size so the file is only parsed again if it has changed
+_ini_cache = {}
+
 
+def ReadIniFile(iniFile):
     # check if file exists.  The call to ConfigParser() does this
     # as well, but by checking ourselves we can return a flag so
     # we can print out a message that we're using defaults.
+    try:
+        st = os.stat(iniFile)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return ConfigParser(), False
+    key = (st.st_mtime_ns, st.st_size)
 
-    file_exists = os.path.isfile(iniFile)
+    cached = _ini_cache.get(iniFile)
+    if cached is not None and cached[0] == key:
+        return cached[1], True
 
     # instantiate
     config = ConfigParser()
 
     # parse existing file
     config.read(iniFile)
+    _ini_cache[iniFile] = (key, config)
+    return config, True
+
+
+def LoadAcquisitionConfiguration(handle, iniFile):
+    # Get current values for fields that aren't in the ini file
+    acq = PyGage.GetAcquisitionConfig(handle)
+    if not isinstance(acq, dict):
+        return acq	
+
+    # file_exists lets us print out a message that we're using defaults.
+    # The parsed file is cached, see ReadIniFile
+    config, file_exists = ReadIniFile(iniFile)
     missing_config = False
 
     if 'Acquisition' in config:
@@ -137,19 +160,11 @@ def LoadChannelConfiguration(handle, channel, iniFile):
     if not isinstance(chan, dict):
         return chan	
 
-    # check if file exists.  The call to ConfigParser() does this
-    # as well, but by checking ourselves we can return a flag so
-    # we can print out a message that we're using defaults.
-
-    file_exists = os.path.isfile(iniFile)
+    # file_exists lets us print out a message that we're using defaults.
+    # The parsed file is cached, see ReadIniFile
+    config, file_exists = ReadIniFile(iniFile)
     missing_config = False
 
-    # instantiate
-    config = ConfigParser()
-
-    # parse existing file
-    config.read(iniFile)
-
     section = 'Channel' + str(channel)
 
     if section in config:
@@ -188,19 +203,11 @@ def LoadTriggerConfiguration(handle, trigger, iniFile):
     if not isinstance(trig, dict):
         return trig	
 
-    # check if file exists.  The call to ConfigParser() does this
-    # as well, but by checking ourselves we can return a flag so
-    # we can print out a message that we're using defaults.
-
-    file_exists = os.path.isfile(iniFile)
+    # file_exists lets us print out a message that we're using defaults.
+    # The parsed file is cached, see ReadIniFile
+    config, file_exists = ReadIniFile(iniFile)
     missing_config = False
 
-    # instantiate
-    config = ConfigParser()
-
-    # parse existing file
-    config.read(iniFile)
-
     section = 'Trigger' + str(trigger)
 
     if section in config:
@@ -260,17 +267,10 @@ def LoadApplicationConfiguration(iniFile):
     app['SaveFileName'] = 'GAGE_FILE'
     app['SaveFileFormat'] = TYPE_DEC
 
-    # check if file exists.  The call to ConfigParser() does this
-    # as well, but by checking ourselves we can return a flag so
-    # we can print out a message that we're using defaults.
-
-    file_exists = os.path.isfile(iniFile)
+    # file_exists lets us print out a message that we're using defaults.
+    # The parsed file is cached, see ReadIniFile
+    config, file_exists = ReadIniFile(iniFile)
     missing_config = False    
-	
-    config = ConfigParser()
-
-    # parse existing file
-    config.read(iniFile)
     section = 'Application'
 	
     if section in config:
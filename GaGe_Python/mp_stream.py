@@ -5,8 +5,13 @@ return the requested information, or an error signal.
 """
 import matplotlib.pyplot as plt
 import gc
-from configparser import ConfigParser  # needed to read ini files
+import os
+import sys
+import ctypes
 import threading
+import traceback
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import time
 import PyGage3_64 as PyGage
 import GageSupport as gs
@@ -36,24 +41,60 @@ from GageErrors import (
     CS_STM_TRANSFER_TIMEOUT,
     CS_STM_COMPLETED,
 )
-import array
+
+# numba is optional, without it the averaging falls back on np.sum
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 # default parameters
 TRANSFER_TIMEOUT = -1  # milliseconds
 STREAM_BUFFERSIZE = 0x200000  # 2097152
+N_BUFFERS = 8  # default number of streaming buffers
 MAX_SEGMENT_COUNT = 25000
 inifile_default = "Stream2Analysis.ini"
 inifile_acquire_default = "Acquire.ini"
 
 
+if njit is not None:
+
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _sum_rows_int16_to_int32(buf, N, ppifg, out):
+        # sum the N rows of length ppifg in the flat int16 buf into out, a row
+        # at a time so the loads are sequential and the inner loop vectorizes.
+        # This is single threaded on purpose, the analysis threads already run
+        # one call each (and nogil lets them run at the same time)
+        for j in range(ppifg):
+            out[j] = 0
+        for i in range(N):
+            row = i * ppifg
+            for j in range(ppifg):
+                out[j] += buf[row + j]
+
+
+def sum_rows(buffer, N, ppifg, out=None):
+    # np.sum(buffer.reshape(N, ppifg), axis=0) for the flat int16 buffer. The
+    # sum goes into out (int32, length ppifg) if it's given
+    if njit is None:
+        # reshape is a view, and summing straight into int32 matches the numba
+        # kernel and skips numpy's default int64 accumulator
+        rows = buffer[: N * ppifg].reshape(N, ppifg)
+        return rows.sum(axis=0, dtype=np.int32, out=out)
+    if out is None:
+        out = np.empty(ppifg, dtype=np.int32)
+    _sum_rows_int16_to_int32(buffer, N, ppifg, out)
+    return out
+
+
 # class used to hold streaming information, attributes listed in __slots__
 # below are assigned later in the card_stream function. The purpose of
 # __slots__ is that it does not allow the user to add new attributes not listed
 # in __slots__ (a kind of neat implementation I hadn't known about).
 class StreamInfo:
     __slots__ = [
-        "WorkBuffer",
         "TimeStamp",
+        "TimeStampIdx",
         "BufferSize",
         "SegmentSize",
         "TailSize",
@@ -163,6 +204,14 @@ def configure_system(handle, inifile):
     return status, g_cardTotalData, g_segmentCounted
 
 
+# StmConfig ini keys -> (app key, conversion from the ini string)
+_stm_keys = {
+    "doanalysis": ("DoAnalysis", lambda value: int(value) != 0),
+    "timeoutontransfer": ("TimeoutOnTransfer", int),
+    "buffersize": ("BufferSize", int),  # in bytes, may need to be an int64
+    "resultsfile": ("ResultsFile", str),
+}
+
 def load_stm_configuration(inifile):
     app = {}
     # set reasonable defaults
@@ -172,27 +221,16 @@ def load_stm_configuration(inifile):
     app["DoAnalysis"] = 0
     app["ResultsFile"] = "Result"
 
-    config = ConfigParser()
-
-    # parse existing file
-    config.read(inifile)
+    config, _ = gs.ReadIniFile(inifile)  # also cached, see gs.ReadIniFile
     section = "StmConfig"
 
     if section in config:
         for key in config[section]:
             key = key.lower()
-            value = config.get(section, key)
-            if key == "doanalysis":
-                if int(value) == 0:
-                    app["DoAnalysis"] = False
-                else:
-                    app["DoAnalysis"] = True
-            elif key == "timeoutontransfer":
-                app["TimeoutOnTransfer"] = int(value)
-            elif key == "buffersize":  # in bytes
-                app["BufferSize"] = int(value)  # may need to be an int64
-            elif key == "resultsfile":
-                app["ResultsFile"] = value
+            if key in _stm_keys:
+                (app_key, convert) = _stm_keys[key]
+                app[app_key] = convert(config.get(section, key))
+
     return app
 
 
@@ -314,6 +352,9 @@ def stream(
     save_channels=1,
     average=False,
     samplerate=1e9,
+    N_buffers=None,
+    producer_core=None,
+    worker_cores=None,
 ):
     """
     GaGe card streaming. This is a process independent function that can be
@@ -330,7 +371,23 @@ def stream(
         mp_values (list, optional): list of mp.Value's for real-time analysis
         mp_arrays (list, optional): list of mp.Array's for real-time analysis
         args_doanalysis (None, optional): any additional arguments to pass for real-time analysis
+        N_buffers (int, optional): number of streaming buffers in the ring,
+            defaults to N_BUFFERS or 2 * N_threads + 2, whichever is larger.
+            More buffers give the analysis threads more slack before the card
+            has to wait on them. Must be at least 2
+        producer_core (int, optional): cpu core to pin the streaming loop to
+        worker_cores (list, optional): cpu cores to pin the analysis threads
+            to, one per thread (cycled through if there are more threads).
+            Keeping them off the producer's core stops the threads migrating
+            between cores
     """
+    # the producer waits on each buffer's buffer_free event before handing it
+    # back to the card, so any number of buffers is safe from being
+    # overwritten, fewer just means more waiting. With a single buffer though
+    # the card is transferring into the same buffer the threads are reading
+    if N_buffers is not None and N_buffers < 2:
+        raise ValueError(f"N_buffers must be at least 2, got {N_buffers}")
+
     # %% ====== handle and config =============================================
     (
         handle,
@@ -370,362 +427,608 @@ def stream(
         print("total samples is: ", total_samples)
 
     # ======================== initalize streaming buffers ====================
+    # the streaming buffers are freed in the finally block, whichever way the
+    # stream ends
     card_index = 1
-    buffer1 = PyGage.GetStreamingBuffer(handle, card_index, app["BufferSize"])
-    if isinstance(buffer1, int):
-        print("Error getting streaming buffer 1: ", PyGage.GetErrorString(buffer1))
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        return
-    buffer2 = PyGage.GetStreamingBuffer(handle, card_index, app["BufferSize"])
-    if isinstance(buffer2, int):
-        print("Error getting streaming buffer 2: ", PyGage.GetErrorString(buffer2))
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        return
-    buffer3 = PyGage.GetStreamingBuffer(handle, card_index, app["BufferSize"])
-    if isinstance(buffer3, int):
-        print("Error getting streaming buffer 2: ", PyGage.GetErrorString(buffer3))
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer2)
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        return
-    buffer4 = PyGage.GetStreamingBuffer(handle, card_index, app["BufferSize"])
-    if isinstance(buffer4, int):
-        print("Error getting streaming buffer 2: ", PyGage.GetErrorString(buffer4))
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer2)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer3)
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        return
-
-    buffer_list = [buffer1, buffer2, buffer3, buffer4]
-
-    wait_time = buffer1.size / (samplerate * save_channels)
-    loop_count_update = int(100e-3 // wait_time)
-    loop_count_update = 1 if loop_count_update == 0 else loop_count_update
-    print(
-        f"single buffer update is {np.round(wait_time * 1e3, 2)}ms updating every {loop_count_update}"
-    )
+    buffer_list = []
+    work_queues = []
+    capture_started = False
+    gc_disabled = False
+    producer_affinity = None
+    try:
+        if N_buffers is None:
+            N_buffers = max(N_BUFFERS, 2 * N_threads + 2)
+        for i in range(N_buffers):
+            buffer = PyGage.GetStreamingBuffer(handle, card_index, app["BufferSize"])
+            if isinstance(buffer, int):
+                print(
+                    f"Error getting streaming buffer {i + 1}: ",
+                    PyGage.GetErrorString(buffer),
+                )
+                stream_error_event.set()
+                return
+            buffer_list.append(buffer)
 
-    #  =========== stream_info instance =======================================
-    # number of samples in data segment
-    acq = PyGage.GetAcquisitionConfig(handle)
-    data_in_segment_samples = acq["SegmentSize"] * (acq["Mode"] & CS_MASKED_MODE)
+        # int16 views of the streaming buffers, made once here instead of an
+        # np.frombuffer for every analyzed buffer
+        buffer_views = [np.frombuffer(b, np.int16) for b in buffer_list]
 
-    status = PyGage.GetSegmentTailSizeInBytes(handle)
-    if status < 0:
-        print("Error: ", PyGage.GetErrorString(status))
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer2)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer3)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer4)
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        return
+        wait_time = buffer_list[0].size / (samplerate * save_channels)
+        loop_count_update = int(100e-3 // wait_time)
+        loop_count_update = 1 if loop_count_update == 0 else loop_count_update
+        print(
+            f"single buffer update is {np.round(wait_time * 1e3, 2)}ms updating every {loop_count_update}"
+        )
 
-    segment_tail_size_in_bytes = status
-    tail_left_over = 0
-
-    sample_size = system_info["SampleSize"]
-    segment_size_in_bytes = data_in_segment_samples * sample_size
-    transfer_size_in_samples = app["BufferSize"] // sample_size
-    print("\nActual buffer size used for data streaming = ", app["BufferSize"])
-    print("\nActual sample size used for data streaming = ", transfer_size_in_samples)
-
-    stream_info = StreamInfo()
-    stream_info.WorkBuffer = np.zeros_like(buffer1)
-    stream_info.TimeStamp = array.array("q")
-    stream_info.BufferSize = app["BufferSize"]
-    stream_info.SegmentSize = segment_size_in_bytes
-    stream_info.TailSize = segment_tail_size_in_bytes
-    stream_info.BytesToEndSegment = segment_size_in_bytes
-    stream_info.BytesToEndTail = segment_tail_size_in_bytes
-    stream_info.LeftOverSize = tail_left_over
-    stream_info.LastTimeStamp = 0
-    stream_info.Segment = 1
-    stream_info.SegmentCountDown = acq["SegmentCount"]
-    stream_info.SplitTail = False
-
-    # %% ========== stream ====================================================
-    done = False
-    stream_completed_success = False
-    work_buffer_active = False
-    loop_count = 0
-    buffer_count = 0
-    thread_count = 0
-
-    # thread count
-    work_threads = [None for i in range(N_threads)]
-    active_threads = [False for i in range(N_threads)]
-    print(f"using {len(work_threads)} threads for analysis")
-
-    stream_ready_event.set()
-
-    # start the capture!
-    status = PyGage.StartCapture(handle)
-    if status < 0:
-        # get error string
-        print("Error: ", PyGage.GetErrorString(status))
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer2)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer3)
-        PyGage.FreeStreamingBuffer(handle, card_index, buffer4)
-        PyGage.FreeSystem(handle)
-        stream_error_event.set()
-        raise SystemExit
+        #  =========== stream_info instance =======================================
+        # number of samples in data segment, the acquisition config was already
+        # read after the commit above
+        acq = acq_config
+        data_in_segment_samples = acq["SegmentSize"] * (acq["Mode"] & CS_MASKED_MODE)
 
-    stream_start_event.set()
+        status = PyGage.GetSegmentTailSizeInBytes(handle)
+        if status < 0:
+            print("Error: ", PyGage.GetErrorString(status))
+            stream_error_event.set()
+            return
 
-    while not done and not stream_completed_success:
-        # select which buffer to stream 2 (toggled in each loop count)
-        buffer = buffer_list[buffer_count]
+        segment_tail_size_in_bytes = status
+        tail_left_over = 0
 
-        # ===== start transfer ================================================
-        status = PyGage.TransferStreamingData(
-            handle, card_index, buffer, transfer_size_in_samples
-        )
-        if status < 0:
-            if status == CS_STM_COMPLETED:
-                # pass (-803 just indicates that the streaming acquisition
-                # completed)
-                pass
-            else:
-                print("Error: ", PyGage.GetErrorString(status))
-                break
-
-        # ==== after starting transfer, start work on the previous buffer =====
-        if work_buffer_active:
-            if active_threads[thread_count]:
-                work_threads[thread_count].join()
-                active_threads[thread_count] = False
-
-            # if saving data, write to a numpy array instead of a multiprocessing Array
-            mode = args_doanalysis[0]
-            if mode == "save" or mode == "save average":
-                if loop_count == 1:
-                    if mode == "save":
-                        savebuffersize = args_doanalysis[1]
-                    else:
-                        ppifg = args_doanalysis[1]
-                        savebuffersize = args_doanalysis[2]
-                    try:
-                        dtype = np.int32 if average else np.int16
-                        memmap = np.zeros(dtype=dtype, shape=(savebuffersize,))
-                        mp_arrays = [memmap]
-
-                    except Exception as e:
-                        print("failed to initialize save buffer \n", e)
-                        stream_error_event.set()
-                        done = True
-                        continue
-
-            # then start the thread on analyzing new data
-            args = (
-                loop_count,
-                g_cardTotalData,
-                stream_info.WorkBuffer,
-                mp_values,
-                mp_arrays,
-                *args_doanalysis,
-            )
-
-            work_threads[thread_count] = threading.Thread(
-                target=DoAnalysis,
-                args=args,
-                kwargs={
-                    "loop_count_update": loop_count_update,
-                },
-            )
-            work_threads[thread_count].start()
-            active_threads[thread_count] = True
-
-        # ===== finish transfer of new data ===================================
-        p = PyGage.GetStreamingTransferStatus(
-            handle, card_index, app["TimeoutOnTransfer"]
+        sample_size = system_info["SampleSize"]
+        segment_size_in_bytes = data_in_segment_samples * sample_size
+        transfer_size_in_samples = app["BufferSize"] // sample_size
+        print("\nActual buffer size used for data streaming = ", app["BufferSize"])
+        print(
+            "\nActual sample size used for data streaming = ", transfer_size_in_samples
         )
-        if isinstance(p, tuple):
-            g_cardTotalData[0] += p[1]  # have total_data be an array, 1 for each card
-            if p[2] == 0:
-                stream_completed_success = False
+
+        stream_info = StreamInfo()
+        # timestamps are preallocated, to add one:
+        # stream_info.TimeStamp[stream_info.TimeStampIdx] = timestamp
+        # stream_info.TimeStampIdx += 1
+        stream_info.TimeStamp = np.empty(MAX_SEGMENT_COUNT, dtype=np.int64)
+        stream_info.TimeStampIdx = 0
+        stream_info.BufferSize = app["BufferSize"]
+        stream_info.SegmentSize = segment_size_in_bytes
+        stream_info.TailSize = segment_tail_size_in_bytes
+        stream_info.BytesToEndSegment = segment_size_in_bytes
+        stream_info.BytesToEndTail = segment_tail_size_in_bytes
+        stream_info.LeftOverSize = tail_left_over
+        stream_info.LastTimeStamp = 0
+        stream_info.Segment = 1
+        stream_info.SegmentCountDown = acq["SegmentCount"]
+        stream_info.SplitTail = False
+
+        # %% ========== stream ====================================================
+        done = False
+        stream_completed_success = False
+        work_buffer_active = False
+        loop_count = 0
+        buffer_count = 0
+        thread_count = 0
+
+        # set by the analysis threads when the save buffer is full. Reading
+        # it is a plain load from shared memory, where polling
+        # stream_stop_event goes through a lock
+        stop_flag = mp.Value("b", 0, lock=False)
+
+        # thread count, the analysis threads are started once here and then fed
+        # jobs through their queues, instead of starting a new thread every loop
+        work_queues += [queue.Queue(maxsize=1) for i in range(N_threads)]
+        if worker_cores:
+            thread_cores = [
+                {worker_cores[i % len(worker_cores)]} for i in range(N_threads)
+            ]
+        else:
+            thread_cores = [None] * N_threads
+        work_threads = [
+            threading.Thread(target=_worker_loop, args=(q, cores), daemon=True)
+            for q, cores in zip(work_queues, thread_cores)
+        ]
+        for thread in work_threads:
+            thread.start()
+        print(f"using {len(work_threads)} threads for analysis")
+
+        # the producer is pinned after the analysis threads are started, so
+        # they don't inherit its affinity. Its old affinity is put back in the
+        # finally block, so the save threads aren't stuck on its core
+        if producer_core is not None:
+            producer_affinity = set_affinity({producer_core})
+
+        # writing to an mp.Array goes element by element through ctypes, so
+        # the analysis gets numpy views of the shared memory instead
+        mp_arrays = [
+            np.ctypeslib.as_array(X.get_obj()) if hasattr(X, "get_obj") else X
+            for X in mp_arrays
+        ]
+
+        # if saving data, write to a numpy array instead of a multiprocessing
+        # Array. The save buffer is a .npy file on disk that the data is
+        # written into as it comes in, so there isn't a big write (or a second
+        # copy in memory) when the stream stops. It's made before the capture
+        # starts, creating the file can take a while (windows fills it in with
+        # zeros)
+        mode = args_doanalysis[0]
+        if mode == "save" or mode == "save average":
+            if mode == "save":
+                savebuffersize = args_doanalysis[1]
             else:
-                stream_completed_success = True
+                ppifg = args_doanalysis[1]
+                savebuffersize = args_doanalysis[2]
+            try:
+                dtype = np.int32 if average else np.int16
+                t = datetime.now().isoformat(timespec="seconds").replace(":", "-")
+                if save_channels == 1:
+                    save_path = f"../data_backup/{t}_ch1.npy"
+                else:
+                    # channels are interleaved, they're split into their own
+                    # files when the stream stops
+                    save_path = f"../data_backup/{t}_interleaved.npy"
+                memmap = np.lib.format.open_memmap(
+                    save_path, mode="w+", dtype=dtype, shape=(savebuffersize,)
+                )
+                mp_arrays = [memmap]
 
-            if STM_TRANSFER_ERROR_FIFOFULL & p[0]:
-                print("Fifo full detected on card ", card_index)
-                done = True
+            except Exception as e:
+                print("failed to initialize save buffer \n", e)
                 stream_error_event.set()
+                return
+
+        analyze = _make_analyzer(
+            args_doanalysis,
+            mp_values,
+            mp_arrays,
+            buffer_views[0].size,
+            loop_count_update=loop_count_update,
+            stop_flag=stop_flag,
+        )
 
-        else:  # error detected
-            done = True
+        # the streaming buffers are used as a ring, the analysis threads work on
+        # the streaming buffer directly instead of on a copy of it. A buffer's
+        # event is cleared while an analysis thread holds it, and it isn't
+        # transferred into again until the thread is done with it
+        buffer_free = [threading.Event() for i in buffer_list]
+        for event in buffer_free:
+            event.set()
+
+        stream_ready_event.set()
+
+        # the cyclic garbage collector going off in the middle of a buffer can
+        # be enough for a fifo full, so it's off for the stream (turned back on
+        # in the finally block). Nothing in the loop makes reference cycles
+        gc.collect()
+        gc.disable()
+        gc_disabled = True
+
+        # start the capture!
+        status = PyGage.StartCapture(handle)
+        if status < 0:
+            # get error string
+            print("Error: ", PyGage.GetErrorString(status))
             stream_error_event.set()
-            if p == CS_STM_TRANSFER_TIMEOUT:
-                print("\nStream transfer timeout on card ", card_index)
-            else:
-                print("5 Error: ", p)
-                print("5 Error: ", PyGage.GetErrorString(p))
+            raise SystemExit
+        capture_started = True
+
+        stream_start_event.set()
+
+        # locals for the loop, saves the attribute and dict lookups each loop
+        transfer = PyGage.TransferStreamingData
+        get_transfer_status = PyGage.GetStreamingTransferStatus
+        timeout = app["TimeoutOnTransfer"]
+        n_buffers = len(buffer_list)
+        n_threads = len(work_threads)
+        # only card 1 is streamed (card_index), so its total is kept as an int
+        # instead of indexing into g_cardTotalData every loop
+        total_data = g_cardTotalData[0]
+
+        while not done and not stream_completed_success:
+            # select which buffer to stream 2 (toggled in each loop count), and
+            # make sure no analysis thread is still working on it
+            buffer = buffer_list[buffer_count]
+            buffer_free[buffer_count].wait()
+
+            # ===== start transfer ================================================
+            status = transfer(handle, card_index, buffer, transfer_size_in_samples)
+            if status < 0:
+                if status == CS_STM_COMPLETED:
+                    # pass (-803 just indicates that the streaming acquisition
+                    # completed)
+                    pass
+                else:
+                    print("Error: ", PyGage.GetErrorString(status))
+                    break
+
+            # ==== after starting transfer, start work on the previous buffer =====
+            if work_buffer_active:
+                # wait for this thread to finish its last job
+                work_queues[thread_count].join()
+
+                # then start the thread on analyzing new data, which is in the
+                # buffer filled on the previous loop
+                work_buffer_count = (loop_count - 1) % n_buffers
+                args = (loop_count, total_data, buffer_views[work_buffer_count])
+
+                buffer_free[work_buffer_count].clear()
+                work_queues[thread_count].put(
+                    (analyze, args, buffer_free[work_buffer_count])
+                )
 
-        # ===== set the buffer with new data as the work buffer ===============
-        stream_info.WorkBuffer[:] = buffer[:]
+            # ===== finish transfer of new data ===================================
+            p = get_transfer_status(handle, card_index, timeout)
+            if isinstance(p, tuple):
+                total_data += p[1]
+                if p[2] == 0:
+                    stream_completed_success = False
+                else:
+                    stream_completed_success = True
 
-        # ===== continue loop =================================================
-        loop_count += 1
-        buffer_count = loop_count % len(buffer_list)
-        thread_count = (loop_count - 1) % len(work_threads)
+                if STM_TRANSFER_ERROR_FIFOFULL & p[0]:
+                    print("Fifo full detected on card ", card_index)
+                    done = True
+                    stream_error_event.set()
 
-        work_buffer_active = True
+            else:  # error detected
+                done = True
+                stream_error_event.set()
+                if p == CS_STM_TRANSFER_TIMEOUT:
+                    print("\nStream transfer timeout on card ", card_index)
+                else:
+                    print("5 Error: ", p)
+                    print("5 Error: ", PyGage.GetErrorString(p))
 
-        if stream_stop_event.is_set():
-            done = True
+            # ===== continue loop =================================================
+            loop_count += 1
+            buffer_count = loop_count % n_buffers
+            thread_count = (loop_count - 1) % n_threads
 
-        print(loop_count)
+            work_buffer_active = True
+
+            # the gui's stop (stream_stop_event) is only checked every
+            # loop_count_update loops
+            if stop_flag.value:
+                done = True
+            elif loop_count % loop_count_update == 0:
+                if stream_stop_event.is_set():
+                    done = True
+
+            # printing every loop is thousands of stdout writes a second
+            if loop_count % loop_count_update == 0:
+                print(loop_count)
+
+        # ===== exiting loop ======================================================
+        # the last buffer is copied since it's analyzed after the card is freed
+        for q in work_queues:
+            q.join()
+        last_buffer = buffer_views[(loop_count - 1) % len(buffer_list)].copy()
+        g_cardTotalData[0] = total_data
+    finally:
+        # the analysis threads have to be done with the streaming buffers
+        # before they're freed
+        for q in work_queues:
+            q.join()
+
+        # free the GaGe card and streaming buffers
+        for buffer in buffer_list:
+            PyGage.FreeStreamingBuffer(handle, card_index, buffer)
+        if capture_started:
+            PyGage.AbortCapture(handle)
+        PyGage.FreeSystem(handle)
 
-    # ===== exiting loop ======================================================
-    # free the GaGe card and streaming buffers
-    PyGage.FreeStreamingBuffer(handle, card_index, buffer1)
-    PyGage.FreeStreamingBuffer(handle, card_index, buffer2)
-    PyGage.FreeStreamingBuffer(handle, card_index, buffer3)
-    PyGage.FreeStreamingBuffer(handle, card_index, buffer4)
-    PyGage.AbortCapture(handle)
-    PyGage.FreeSystem(handle)
+        if gc_disabled:
+            gc.enable()
+        if producer_affinity is not None:
+            set_affinity(producer_affinity)
 
     # Do analysis on the last buffer. Sometimes the data can take a while to
     # save, so freeing the card first allows you to launch another gui while
     # this one is saving.
-    if active_threads[thread_count]:
-        work_threads[thread_count].join()
+    args = (loop_count, total_data, last_buffer)
+    work_queues[thread_count].put((analyze, args, None))
 
-    args = (
-        loop_count,
-        g_cardTotalData,
-        stream_info.WorkBuffer,
-        mp_values,
-        mp_arrays,
-        *args_doanalysis,
-    )
-    work_threads[thread_count] = threading.Thread(
-        target=DoAnalysis,
-        args=args,
-        kwargs={
-            "loop_count_update": loop_count_update,
-        },
-    )
-    work_threads[thread_count].start()
-    work_threads[thread_count].join()
+    # stop the analysis threads once they've finished their jobs
+    for q in work_queues:
+        q.put(None)
+    for thread in work_threads:
+        thread.join()
 
+    # make sure the gui sees the final values
+    (mp_total_data, mp_loop_count) = mp_values
+    mp_total_data.value = total_data
+    mp_loop_count.value = loop_count
+
+    saved_files = []
     if mode == "save" or mode == "save average":
         if mode == "save":
-            step = buffer.size
+            step = last_buffer.size
         else:
             step = ppifg
-        end = step * loop_count
-        t = datetime.now().isoformat(timespec="seconds").replace(":", "-")
+        end = min(step * loop_count, memmap.size)
+        memmap.flush()
         if save_channels == 1:
-            np.save(f"../data_backup/{t}_ch1.npy", memmap[:end])
+            # the memmap has to be let go of before the file can be cut short
+            # (on windows)
+            size = memmap.size
+            args = mp_arrays = memmap = analyze = None
+            if end < size:
+                try:
+                    truncate_npy(save_path, end)
+                except OSError as e:
+                    print("failed to trim the save file \n", e)
+            saved_files = [save_path]
         else:
-            N = memmap.size // save_channels
-            memmap.resize((N, save_channels))
-            for i in range(save_channels):
-                np.save(
-                    f"../data_backup/{t}_ch{i + 1}.npy",
-                    memmap[: end // save_channels][:, i],
-                )
+            # reshape is a view so nothing is copied here
+            channels = memmap[:end].reshape(-1, save_channels)
+            saved_files = [
+                f"../data_backup/{t}_ch{i + 1}.npy" for i in range(save_channels)
+            ]
+            save_npy([(path, channels[:, i]) for i, path in enumerate(saved_files)])
+            args = mp_arrays = memmap = channels = analyze = None
+            try:
+                os.remove(save_path)
+            except OSError as e:
+                print("failed to remove the interleaved save file \n", e)
 
     # the tracking thread will wait for this flag before clearing all of the
     # multiprocessing events. You don't want to clear all events here either
     # because then the tracking thread won't know to stop
     stream_exit_event.set()
 
+    # syncing the save files to disk waits on every byte being written, so
+    # it's done after the gui has been let go of. The process exits once the
+    # thread is done
+    if saved_files:
+        threading.Thread(target=drop_from_page_cache, args=(saved_files,)).start()
+
+
+def save_npy(files):
+    """
+    np.save several arrays at once, each to its own file on its own thread
+    (file writes release the GIL), so the writes don't wait on each other.
+
+    Args:
+        files (list): list of (path, array) tuples
+    """
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        futures = [executor.submit(np.save, path, x) for path, x in files]
+        for future in futures:
+            future.result()
+
+
+def drop_from_page_cache(paths):
+    """
+    Tell the kernel saved files won't be read again, so several GB of save
+    data doesn't push everything else (the next stream's buffers) out of the
+    page cache. Each file is synced to disk first, only clean pages can be
+    dropped, so this blocks until they're written. Does nothing where
+    os.posix_fadvise isn't available (windows)
+
+    Args:
+        paths (list): paths to the saved files
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print("failed to drop the save file from the page cache \n", e)
+
+
+def truncate_npy(path, n):
+    """
+    Cut a 1D .npy file down to its first n elements in place. The shape in the
+    header is rewritten (padded out to the same length) and the rest of the
+    file is truncated.
+
+    Args:
+        path (string): path to the .npy file
+        n (int): number of elements to keep
+    """
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(f)
+        else:
+            (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+        # the header text starts after the magic string and the header length
+        start = np.lib.format.MAGIC_LEN + (2 if version == (1, 0) else 4)
+        header = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": fortran_order,
+            "shape": (n,),
+        }
+        header = repr(header).ljust(offset - start - 1) + "\n"
+
+        f.seek(start)
+        f.write(header.encode("latin1"))
+        f.truncate(offset + n * dtype.itemsize)
+
+
+def set_affinity(cores):
+    """
+    Pin the calling thread to the given cpu cores, with os.sched_setaffinity
+    on linux and SetThreadAffinityMask on windows.
+
+    Args:
+        cores (set): cpu core indices
 
-def DoAnalysis(
-    loop_count,
-    g_cardTotalData,
-    workbuffer,
-    mp_values,
-    mp_arrays,
-    *args,
-    loop_count_update=1,
+    Returns:
+        set: the thread's previous cpu cores, pass them to set_affinity to
+        restore them. None if the affinity couldn't be set
+    """
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            previous = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cores)
+            return previous
+        if sys.platform == "win32":
+            kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+            kernel32.GetCurrentThread.restype = ctypes.c_void_p
+            kernel32.SetThreadAffinityMask.restype = ctypes.c_size_t
+            kernel32.SetThreadAffinityMask.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+            mask = sum(1 << core for core in cores)
+            previous = kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), mask)
+            if previous == 0:
+                raise ctypes.WinError(ctypes.get_last_error())
+            return {
+                core for core in range(previous.bit_length()) if previous >> core & 1
+            }
+        print("setting the cpu affinity isn't supported on this platform")
+    except (OSError, ValueError) as e:
+        print("failed to set cpu affinity \n", e)
+    return None
+
+
+def _worker_loop(q, cores=None):
+    # long lived analysis thread, runs the analysis function of every job put
+    # in the queue until it gets None. Once done, the job's buffer_free event
+    # (if there is one) is set so the stream can transfer into that buffer
+    # again. An error in one job is printed and the thread moves on to the
+    # next, a dead thread would leave the stream waiting on its queue forever
+    if cores is not None:
+        set_affinity(cores)
+    while True:
+        job = q.get()
+        if job is None:
+            q.task_done()
+            break
+        analyze, args, buffer_free = job
+        try:
+            analyze(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if buffer_free is not None:
+                buffer_free.set()
+            q.task_done()
+
+
+def _make_analyzer(
+    args, mp_values, mp_arrays, buffer_size, loop_count_update=1, stop_flag=None
 ):
     """
-    Do analysis on stream work buffer
+    Make the analysis function that's run on the stream's work buffers.
+    Everything that's fixed for the whole stream (the mode and its arguments,
+    the number of interferograms in a buffer) is unpacked here once, so the
+    returned function only does the work on the buffer
 
     Args:
-        loop_count (int):
-            current loop count in the stream while loop
-        g_cardTotalData (list):
-            list of total data, they make it a list for each card, so you'll
-            only have one element in the list
-        workbuffer (buffer):
-            stream's work buffer. You can retrieve it with np.formbuffer(workbuffer, np.int16)
-        mp_values (list of mp.Value):'
-            You passed this list to the stream function to be actively updated by
-            this DoAnalysis function
-        mp_arrays (list of mp.Array):
-            You passed this list to the stream function to be actively updated by
-            this DoAnalysis function
         args (tuple):
-            tuple containing additional arguments you passed to the stream
-            function that are needed by this DoAnalysis function
+            the args_doanalysis passed to the stream function, the mode
+            followed by the additional arguments that mode needs
+        mp_values (list of mp.Value):
+            You passed this list to the stream function to be actively updated
+            by the analysis
+        mp_arrays (list of np.ndarray):
+            numpy views of the mp.Array's you passed to the stream function
+            (or the save buffer), to be actively updated by the analysis
+        buffer_size (int):
+            number of int16 samples in a work buffer
+        loop_count_update (int, optional):
+            the mp.Array's and mp.Value's are only updated every
+            loop_count_update loops
+        stop_flag (mp.Value, optional):
+            set along with the stream_stop_event when the save buffer is full,
+            the stream checks it every loop
+
+    Returns:
+        function:
+            analyze(loop_count, total_data, buffer). loop_count is the current
+            loop count in the stream while loop, total_data the total data
+            streamed so far and buffer the int16 view of the stream's work
+            buffer
     """
     (mode, *args_remaining) = args
-    buffer = np.frombuffer(workbuffer, np.int16)
+    (mp_total_data, mp_loop_count) = mp_values
 
-    if mode == "average":
+    def update_values(loop_count, total_data):
+        # writing an mp.Value takes a lock shared with the gui process, only do
+        # it every loop_count_update loops. The stream sets the final values
         if loop_count % loop_count_update == 0:
-            # print("updating", loop_count)
-            (ppifg,) = args_remaining
-            N = int(buffer.size // ppifg)
-            buffer.resize((N, ppifg))
+            mp_total_data.value = total_data
+            mp_loop_count.value = loop_count
 
-            (X,) = mp_arrays
-            end = len(X)
-            X[:] = np.sum(buffer, axis=0)[:end]
+    def request_stop(stream_stop_event):
+        # the event is for the gui, the stream checks stop_flag
+        stream_stop_event.set()
+        if stop_flag is not None:
+            stop_flag.value = 1
 
-    elif mode == "save average":
-        (ppifg, savebuffersize, stream_stop_event) = args_remaining
-        N = int(buffer.size // ppifg)
+    if mode == "average":
+        (ppifg,) = args_remaining
+        N = buffer_size // ppifg
+        (X,) = mp_arrays
+        end = len(X)
 
-        if loop_count * ppifg == savebuffersize:
-            stream_stop_event.set()
-        if loop_count * ppifg > savebuffersize:
-            stream_stop_event.set()
-            print("stop flag already set, skipping this one")
-            return
+        # each analysis thread sums into its own array, instead of allocating
+        # one every buffer
+        scratch = threading.local()
 
-        buffer.resize((N, ppifg))
-        summed = np.sum(buffer, axis=0)
+        def analyze(loop_count, total_data, buffer):
+            if loop_count % loop_count_update == 0:
+                if not hasattr(scratch, "summed"):
+                    scratch.summed = np.empty(ppifg, dtype=np.int32)
+                X[:] = sum_rows(buffer, N, ppifg, out=scratch.summed)[:end]
+            update_values(loop_count, total_data)
 
+    elif mode == "save average":
+        (ppifg, savebuffersize, stream_stop_event) = args_remaining
+        N = buffer_size // ppifg
         (X,) = mp_arrays
-        start = (loop_count - 1) * ppifg
-        stop = loop_count * ppifg
-        X[start:stop] = summed
+        # the int32 save buffer is summed into directly, nothing is allocated
+        # or copied per buffer
+        sum_into_X = X.dtype == np.int32 and X.flags.c_contiguous
+
+        def analyze(loop_count, total_data, buffer):
+            if loop_count * ppifg == savebuffersize:
+                request_stop(stream_stop_event)
+            if loop_count * ppifg > savebuffersize:
+                request_stop(stream_stop_event)
+                print("stop flag already set, skipping this one")
+                return
+
+            start = (loop_count - 1) * ppifg
+            if sum_into_X:
+                sum_rows(buffer, N, ppifg, out=X[start : start + ppifg])
+            else:
+                X[start : start + ppifg] = sum_rows(buffer, N, ppifg)
+            update_values(loop_count, total_data)
 
     elif mode == "save":
         (savebuffersize, stream_stop_event) = args_remaining
-        size = buffer.size
+        (X,) = mp_arrays
 
-        if loop_count * size == savebuffersize:
-            stream_stop_event.set()
+        def analyze(loop_count, total_data, buffer):
+            if loop_count * buffer_size == savebuffersize:
+                request_stop(stream_stop_event)
 
-        if loop_count * size > savebuffersize:
-            stream_stop_event.set()
-            print("stop flag already set, skipping this one")
-            return
+            if loop_count * buffer_size > savebuffersize:
+                request_stop(stream_stop_event)
+                print("stop flag already set, skipping this one")
+                return
 
-        (X,) = mp_arrays
-        start = (loop_count - 1) * size
-        stop = loop_count * size
-        X[start:stop] = buffer
+            start = (loop_count - 1) * buffer_size
+            X[start : start + buffer_size] = buffer
+            update_values(loop_count, total_data)
 
     elif mode == "pass":
-        if loop_count % loop_count_update == 0:
-            # print("updating", loop_count)
-            (X,) = mp_arrays
-            X[:] = buffer[: len(X)]
+        (X,) = mp_arrays
+        end = len(X)
 
-    (mp_total_data, mp_loop_count) = mp_values
-    mp_total_data.value = g_cardTotalData[0]
-    mp_loop_count.value = loop_count
+        def analyze(loop_count, total_data, buffer):
+            if loop_count % loop_count_update == 0:
+                X[:] = buffer[:end]
+            update_values(loop_count, total_data)
+
+    else:
+        analyze = update_values
+
+    return analyze